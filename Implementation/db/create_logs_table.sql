@@ -14,8 +14,11 @@ CREATE TABLE IF NOT EXISTS logs (
   src_ip INET,
   user_name TEXT,
   full_log JSONB NOT NULL,
-  raw_sha256 CHAR(64) UNIQUE
+  raw_sha256 BYTEA UNIQUE          -- sha256 digest of the raw alert line
 );
+-- PG14+: lz4 TOAST compression for the raw alerts
+ALTER TABLE logs ALTER COLUMN full_log SET COMPRESSION lz4;
+CREATE INDEX IF NOT EXISTS ix_logs_ts ON logs (ts);
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO soc_user;
 GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO soc_user;
 SQL
@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 import os
+import io
 import sys
-import json
+import mmap
+import socket
+import struct
 import hashlib
 import datetime as dt
-from ipaddress import ip_address
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 
+import orjson
 import psycopg2
-from psycopg2.extras import Json
 from dateutil import parser as dtp
 
 # ----------------------------
 # Config
 # ----------------------------
 ALERTS_PATH = "/var/ossec/logs/alerts/alerts.json"
-STATE_FILE  = "/opt/soc_etl/last_ts.txt"  # stores last processed ISO8601 UTC timestamp
+# stores "<last ISO8601 UTC ts> <byte offset> <inode>" of the last run
+# (older files hold just the timestamp; offset/inode then default to 0)
+STATE_FILE  = "/opt/soc_etl/last_ts.txt"
 
 PGHOST = os.getenv("PGHOST", "127.0.0.1")
 PGPORT = int(os.getenv("PGPORT", "5432"))
@@ -22,6 +30,26 @@ PGDB   = os.getenv("PGDATABASE", "soc_logs")
 PGUSER = os.getenv("PGUSER", "soc_user")
 PGPW   = os.getenv("PGPASSWORD", "")
 
+# alerts.json is cut into line-aligned byte ranges of about this size,
+# each parsed+hashed by one worker process
+RANGE_SIZE = 16 << 20
+ETL_WORKERS = int(os.getenv("ETL_WORKERS", "2"))
+
+# catch-up runs over files at least this big load without the ts index
+# and rebuild it afterwards
+BULK_LOAD_BYTES = int(os.getenv("BULK_LOAD_BYTES", str(256 << 20)))
+
+# rows buffered in memory before each COPY into the staging table
+BATCH_SIZE = 50_000
+
+# shared stand-in for missing agent/rule/data objects (never mutated)
+_EMPTY: dict = {}
+
+LOG_COLUMNS = (
+    "ts, agent_name, agent_id, rule_id, rule_level, rule_desc, "
+    "src_ip, user_name, full_log, raw_sha256"
+)
+
 # ----------------------------
 # Helpers
 # ----------------------------
@@ -34,53 +62,339 @@ def utcify(ts: dt.datetime | None) -> dt.datetime | None:
         return ts.replace(tzinfo=dt.timezone.utc)
     return ts.astimezone(dt.timezone.utc)
 
+# older fromisoformat() rejects the "Z" suffix
+_ISO_FIX = str.maketrans({"Z": "+00:00"})
+
 def parse_ts(value) -> dt.datetime | None:
-    """Parse Wazuh timestamps like @timestamp/timestamp → aware UTC dt."""
-    if not value:
+    """Parse Wazuh timestamps like @timestamp/timestamp → aware UTC dt.
+
+    Wazuh emits fixed ISO-8601 (e.g. 2024-01-15T14:30:00.000+0000), so try
+    fromisoformat first and only fall back to dateutil for odd formats.
+    """
+    # non-strings (lists/dicts in odd alerts) aren't timestamps, and would
+    # also be unhashable for the cache below
+    if not value or not isinstance(value, str):
         return None
+    return _parse_ts_str(value)
+
+# consecutive alerts often share a timestamp, hence the tiny cache
+@lru_cache(maxsize=4)
+def _parse_ts_str(value: str) -> dt.datetime | None:
+    try:
+        return utcify(dt.datetime.fromisoformat(value.translate(_ISO_FIX)))
+    except ValueError:
+        return _parse_ts_slow(value)
+
+def _parse_ts_slow(value) -> dt.datetime | None:
     try:
         return utcify(dtp.parse(value))
     except Exception:
         return None
 
 def to_inet(v: str | None) -> str | None:
-    if not v:
-        return None
-    try:
-        ip_address(v)
-        return v
-    except Exception:
+    """Return v if it is a valid IPv4/IPv6 address, else None."""
+    # non-strings (lists/dicts) are never addresses and would be unhashable below
+    if not v or not isinstance(v, str):
         return None
+    return _to_inet_str(v)
+
+# cached: most alerts repeat a small set of source IPs
+@lru_cache(maxsize=8192)
+def _to_inet_str(v: str) -> str | None:
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, v)
+            return v
+        except (OSError, ValueError):
+            continue
+    return None
 
 def ensure_state_dir():
     d = os.path.dirname(STATE_FILE)
     if d and not os.path.exists(d):
         os.makedirs(d, exist_ok=True)
 
-def get_last_ts() -> dt.datetime:
-    """Read last processed ts from STATE_FILE; default far past in UTC."""
+def get_state() -> tuple[dt.datetime, int, int]:
+    """Read (last_ts, byte_offset, inode) from STATE_FILE; defaults (far past UTC, 0, 0)."""
+    min_ts = dt.datetime.min.replace(tzinfo=dt.timezone.utc)
     try:
         with open(STATE_FILE, "r", encoding="utf-8") as f:
-            raw = f.read().strip()
-        if not raw:
-            return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
-        return utcify(dtp.parse(raw))
+            parts = f.read().split()
     except FileNotFoundError:
-        return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
-    except Exception:
+        return min_ts, 0, 0
+    if not parts:
+        return min_ts, 0, 0
+    ts = parse_ts(parts[0])
+    try:
+        offset = int(parts[1]) if len(parts) > 1 else 0
+        inode = int(parts[2]) if len(parts) > 2 else 0
+    except ValueError:
+        ts = None
+    if ts is None:
         # on any parse issue, start from min
-        return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+        return min_ts, 0, 0
+    return ts, offset, inode
 
-def save_last_ts(ts: dt.datetime):
+def save_state(ts: dt.datetime, offset: int, inode: int):
     ensure_state_dir()
     with open(STATE_FILE, "w", encoding="utf-8") as f:
-        f.write(ts.astimezone(dt.timezone.utc).isoformat())
+        f.write(f"{ts.astimezone(dt.timezone.utc).isoformat()} {offset} {inode}")
+
+def resume_offset(path: str, offset: int, inode: int) -> int:
+    """
+    Byte offset to resume scanning from: the saved offset if this is still the
+    same, un-truncated file, else 0 (rotated/replaced → full scan).
+    """
+    st = os.stat(path)
+    if offset <= 0 or st.st_ino != inode or st.st_size < offset:
+        return 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[offset - 1] == 0x0A:
+            return offset
+        # not on a line boundary; skip to the next one
+        nl = mm.find(b"\n", offset)
+        return nl + 1 if nl != -1 else st.st_size
+
+def complete_end(path: str, size: int) -> int:
+    """Offset just past the last newline, so a half-written tail line waits for the next run."""
+    if size == 0:
+        return 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm.rfind(b"\n", 0, size) + 1
 
 def open_db():
     return psycopg2.connect(
         host=PGHOST, port=PGPORT, dbname=PGDB, user=PGUSER, password=PGPW
     )
 
+# ----------------------------
+# Binary COPY encoding (one encoder per LOG_COLUMNS entry)
+# ----------------------------
+PG_EPOCH = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+COPY_HEADER  = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+_NULL  = struct.pack("!i", -1)
+_int4  = struct.Struct("!i").pack
+_int8  = struct.Struct("!q").pack
+_int2  = struct.Struct("!h").pack
+_USEC  = dt.timedelta(microseconds=1)
+
+def _enc_timestamptz(v: dt.datetime) -> bytes:
+    return _int8((v - PG_EPOCH) // _USEC)
+
+def _enc_text(v) -> bytes:
+    if isinstance(v, str):
+        return v.encode("utf-8")
+    if isinstance(v, (dict, list)):
+        # don't store Python reprs of JSON objects/arrays in a text column
+        raise ValueError(f"non-scalar value for text column: {type(v).__name__}")
+    return str(v).encode("utf-8")
+
+def _enc_int4(v) -> bytes:
+    try:
+        return _int4(int(v))
+    except (TypeError, OverflowError, struct.error) as e:
+        # dict/list/None-ish or out of int4 range
+        raise ValueError(f"value not valid for integer column: {v!r}") from e
+
+def _enc_inet(v: str) -> bytes:
+    # family (PGSQL_AF_INET=2 / PGSQL_AF_INET6=3), bits, is_cidr, nbytes, addr
+    if ":" in v:
+        return bytes((3, 128, 0, 16)) + socket.inet_pton(socket.AF_INET6, v)
+    return bytes((2, 32, 0, 4)) + socket.inet_pton(socket.AF_INET, v)
+
+def _enc_jsonb(v: bytes) -> bytes:
+    # jsonb binary format: version byte 1 + JSON text
+    return b"\x01" + v
+
+def _enc_bytea(v: bytes) -> bytes:
+    return v
+
+COLUMN_ENCODERS = (
+    _enc_timestamptz,  # ts
+    _enc_text,         # agent_name
+    _enc_text,         # agent_id
+    _enc_int4,         # rule_id
+    _enc_int4,         # rule_level
+    _enc_text,         # rule_desc
+    _enc_inet,         # src_ip
+    _enc_text,         # user_name
+    _enc_jsonb,        # full_log
+    _enc_bytea,        # raw_sha256
+)
+
+def copy_binary(rows: list[tuple]) -> bytes:
+    """Encode rows as a PostgreSQL binary COPY stream.
+
+    Raises ValueError on values the column types can't hold.
+    """
+    out = [COPY_HEADER]
+    add = out.append
+    nfields = _int2(len(COLUMN_ENCODERS))
+    for row in rows:
+        add(nfields)
+        for v, enc in zip(row, COLUMN_ENCODERS):
+            if v is None:
+                add(_NULL)
+            else:
+                data = enc(v)
+                add(_int4(len(data)))
+                add(data)
+    add(COPY_TRAILER)
+    return b"".join(out)
+
+def sha256_many(lines: list[bytes]) -> list[bytes]:
+    """Raw 32-byte SHA-256 of each line; one tight loop per batch instead of per-row calls."""
+    sha256 = hashlib.sha256
+    return [sha256(b).digest() for b in lines]
+
+def load_recent_hashes(cur, since: dt.datetime) -> set[bytes]:
+    """
+    Hashes of rows newer than `since` (e.g. loaded after last_ts by a run that
+    didn't save its state), so those lines skip the DB. Older rows can't match:
+    only lines with ts > since are loaded.
+    """
+    cur.execute(
+        "SELECT raw_sha256 FROM logs WHERE ts > %s AND raw_sha256 IS NOT NULL",
+        (since,),
+    )
+    return {bytes(r[0]) for r in cur.fetchall()}
+
+def flush_batch(cur, rows: list[tuple]) -> int:
+    """COPY rows into logs_staging, merge into logs.
+
+    Returns the number of rows actually inserted into logs.
+    """
+    buf = io.BytesIO(copy_binary(rows))
+    cur.copy_expert(f"COPY logs_staging ({LOG_COLUMNS}) FROM STDIN WITH (FORMAT BINARY)", buf)
+    cur.execute("EXECUTE merge_staging")
+    inserted = cur.rowcount
+    cur.execute("TRUNCATE logs_staging")
+    return inserted
+
+def insert_rows(cur, rows: list[tuple]) -> tuple[int, int]:
+    """
+    Row-by-row fallback for a batch whose COPY failed, so one bad row only
+    costs itself. Returns (inserted, failed).
+    """
+    inserted = 0
+    failed = 0
+    for row in rows:
+        # full_log is raw JSON bytes; as a parameter it must go in as text, not bytea
+        row = row[:8] + (row[8].decode("utf-8"),) + row[9:]
+        try:
+            cur.execute("EXECUTE insert_log (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", row)
+            inserted += cur.rowcount
+        except psycopg2.Error:
+            failed += 1
+    return inserted, failed
+
+def split_seeks(path: str, range_size: int, start: int, size: int) -> list[tuple[int, int]]:
+    """Cut [start, size) of the file into (start, end) byte ranges that each end on a newline."""
+    ranges = []
+    if start >= size:
+        return ranges
+    # boundary search via mmap.find (memchr over the page cache, no reads/copies)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < size:
+            end = start + range_size
+            if end >= size:
+                end = size
+            else:
+                nl = mm.find(b"\n", end, size)
+                end = nl + 1 if nl != -1 else size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def parse_range(path: str, start: int, end: int, last_ts: dt.datetime):
+    """
+    Parse and hash the alert lines in [start, end) of the file.
+    Runs in a worker process; returns (rows, scanned, skipped_old) where each
+    row ends with the raw line's sha256 digest.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    rows = []
+    lines = []
+    scanned = 0
+    skipped_old = 0
+    # hot loop: bind globals/methods to locals once instead of per line
+    loads = orjson.loads
+    add_row = rows.append
+    add_line = lines.append
+    _parse_ts = parse_ts
+    _to_inet = to_inet
+    empty = _EMPTY
+    for line in chunk.split(b"\n"):
+        line = line.rstrip(b"\r")
+        if not line:
+            continue
+        scanned += 1
+
+        try:
+            j = loads(line)
+        except Exception:
+            # ignore malformed lines
+            continue
+        get = j.get
+
+        # timestamp
+        ts = _parse_ts(get("@timestamp") or get("timestamp"))
+        if ts is None:
+            # some lines may lack ts; skip
+            continue
+
+        # skip if already processed in previous runs
+        if ts <= last_ts:
+            skipped_old += 1
+            continue
+
+        # flatten fields
+        agent = get("agent") or empty
+        rule  = get("rule") or empty
+        data  = get("data") or empty
+        rule_get = rule.get
+        data_get = data.get
+
+        add_row((
+            ts, agent.get("name"), agent.get("id"),
+            rule_get("id"), rule_get("level"), rule_get("description"),
+            _to_inet(data_get("srcip") or get("srcip")),
+            data_get("user") or get("user"),
+            # raw line is already valid JSON (orjson parsed it); no re-serialize
+            line,
+        ))
+        add_line(line)
+
+    # dedupe hashes for the kept lines, computed in one pass
+    rows = [row + (digest,) for row, digest in zip(rows, sha256_many(lines))]
+    return rows, scanned, skipped_old
+
+def iter_parsed(path: str, last_ts: dt.datetime, start: int, stop: int):
+    """Yield parse_range results for [start, stop) in file order, fanning out to ETL_WORKERS processes."""
+    ranges = split_seeks(path, RANGE_SIZE, start, stop)
+    if ETL_WORKERS <= 1 or len(ranges) <= 1:
+        for lo, hi in ranges:
+            yield parse_range(path, lo, hi, last_ts)
+        return
+
+    # keep only a few ranges in flight so parsed rows don't pile up in memory
+    with ProcessPoolExecutor(max_workers=ETL_WORKERS) as pool:
+        todo = iter(ranges)
+        pending = deque(
+            pool.submit(parse_range, path, lo, hi, last_ts)
+            for lo, hi in islice(todo, ETL_WORKERS * 2)
+        )
+        while pending:
+            result = pending.popleft().result()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append(pool.submit(parse_range, path, nxt[0], nxt[1], last_ts))
+            yield result
+
 # ----------------------------
 # Main
 # ----------------------------
@@ -113,89 +427,144 @@ def main():
         END$$;
     """)
 
-    last_ts = get_last_ts()
+    # raw_sha256 used to be hex CHAR(64); store the 32-byte digest instead
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = 'logs'
+                  AND column_name = 'raw_sha256' AND data_type <> 'bytea'
+            ) THEN
+                ALTER TABLE logs
+                    ALTER COLUMN raw_sha256 TYPE bytea USING decode(raw_sha256, 'hex');
+            END IF;
+        END$$;
+    """)
+
+    # full_log compresses well (repetitive keys); lz4 is cheaper than pglz (PG14+)
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 140000 THEN
+                BEGIN
+                    IF (SELECT attcompression FROM pg_attribute
+                        WHERE attrelid = 'logs'::regclass AND attname = 'full_log') <> 'l' THEN
+                        EXECUTE 'ALTER TABLE logs ALTER COLUMN full_log SET COMPRESSION lz4';
+                    END IF;
+                EXCEPTION WHEN feature_not_supported THEN
+                    -- server built without lz4
+                    NULL;
+                END;
+            END IF;
+        END$$;
+    """)
+
+    # Staging table for COPY; merged into logs once per batch. TEMP keeps it
+    # private to this session (overlapping runs, e.g. via /etl/run, can't drop
+    # or truncate each other's rows) and unlogged; created per run so it
+    # always mirrors the current logs columns.
+    cur.execute("CREATE TEMP TABLE logs_staging (LIKE logs INCLUDING DEFAULTS)")
+
+    # Merge statement is parsed/planned once per run, EXECUTEd per batch
+    cur.execute(f"""
+        PREPARE merge_staging AS
+        INSERT INTO logs ({LOG_COLUMNS})
+        SELECT DISTINCT ON (raw_sha256) {LOG_COLUMNS}
+        FROM logs_staging
+        ON CONFLICT (raw_sha256) DO NOTHING
+    """)
+    cur.execute(f"""
+        PREPARE insert_log AS
+        INSERT INTO logs ({LOG_COLUMNS})
+        VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
+        ON CONFLICT (raw_sha256) DO NOTHING
+    """)
+
+    last_ts, last_offset, last_inode = get_state()
     new_ts  = last_ts
+
+    # Append-only file: pick up where the last run stopped instead of
+    # re-parsing everything (falls back to 0 after rotation/truncation)
+    inode = os.stat(ALERTS_PATH).st_ino
+    start = resume_offset(ALERTS_PATH, last_offset, last_inode)
+    stop  = complete_end(ALERTS_PATH, os.path.getsize(ALERTS_PATH))
     inserted = 0
     scanned  = 0
     skipped_old = 0
     skipped_dupe = 0
+    failed = 0
+
+    # digests already in logs or earlier in this run; dupes never reach Postgres
+    min_ts = dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+    seen: set[bytes] = set()
+    if last_ts > min_ts:
+        seen = load_recent_hashes(cur, last_ts)
+
+    # Big catch-up run: skip per-row maintenance of the ts index while loading.
+    # ux_logs_raw_sha256 stays, ON CONFLICT needs it.
+    bulk = last_ts == min_ts or stop - start >= BULK_LOAD_BYTES
+    if bulk:
+        cur.execute("DROP INDEX IF EXISTS ix_logs_ts")
 
-    # Stream line-by-line (JSON per line)
-    with open(ALERTS_PATH, "r", encoding="utf-8", errors="ignore") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            scanned += 1
-
-            # quick hash for dedupe
-            raw_hash = hashlib.sha256(line.encode("utf-8")).hexdigest()
-
-            try:
-                j = json.loads(line)
-            except Exception:
-                # ignore malformed lines
-                continue
-
-            # timestamp
-            ts = parse_ts(j.get("@timestamp") or j.get("timestamp"))
-            if ts is None:
-                # some lines may lack ts; skip
-                continue
-
-            # skip if already processed in previous runs
-            if ts <= last_ts:
-                skipped_old += 1
-                continue
-
-            # flatten fields
-            agent = j.get("agent") or {}
-            rule  = j.get("rule") or {}
-            data  = j.get("data") or {}
-
-            agent_name = agent.get("name")
-            agent_id   = agent.get("id")
-            rule_id    = rule.get("id")
-            rule_level = rule.get("level")
-            rule_desc  = rule.get("description")
-            src_ip     = to_inet(data.get("srcip") or j.get("srcip"))
-            user_name  = data.get("user") or j.get("user")
-
-            try:
-                cur.execute("""
-                    INSERT INTO logs
-                        (ts, agent_name, agent_id, rule_id, rule_level, rule_desc, src_ip, user_name, full_log, raw_sha256)
-                    VALUES
-                        (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON CONFLICT (raw_sha256) DO NOTHING
-                """, (
-                    ts, agent_name, agent_id, rule_id, rule_level, rule_desc,
-                    src_ip, user_name, Json(j), raw_hash
-                ))
-                if cur.rowcount == 1:
-                    inserted += 1
-                    if ts > new_ts:
-                        new_ts = ts
-                else:
-                    # conflict hit (duplicate)
+    rows: list[tuple] = []
+    batch_max_ts = last_ts
+
+    def flush():
+        nonlocal inserted, skipped_dupe, failed, new_ts
+        if not rows:
+            return
+        bad = 0
+        try:
+            n = flush_batch(cur, rows)
+        except (psycopg2.Error, ValueError) as e:
+            # COPY is all-or-nothing; retry this batch row by row and keep going
+            msg = e.pgerror if isinstance(e, psycopg2.Error) and e.pgerror else str(e)
+            print(f"Batch load failed, retrying per row: {msg}", file=sys.stderr)
+            cur.execute("TRUNCATE logs_staging")
+            n, bad = insert_rows(cur, rows)
+        inserted += n
+        failed += bad
+        skipped_dupe += len(rows) - n - bad
+        if batch_max_ts > new_ts:
+            new_ts = batch_max_ts
+        rows.clear()
+
+    try:
+        # Workers parse+hash byte ranges; this process only dedupes and COPYs
+        for part_rows, part_scanned, part_old in iter_parsed(ALERTS_PATH, last_ts, start, stop):
+            scanned += part_scanned
+            skipped_old += part_old
+            for row in part_rows:
+                digest = row[-1]
+                if digest in seen:
                     skipped_dupe += 1
-            except psycopg2.Error as e:
-                # Keep going on individual row errors
-                # (Optional) print a short diagnostic line:
-                # print(f"DB error on insert: {e.pgerror or str(e)}", file=sys.stderr)
-                continue
+                    continue
+                seen.add(digest)
+                rows.append(row)
+                if row[0] > batch_max_ts:
+                    batch_max_ts = row[0]
+
+                if len(rows) >= BATCH_SIZE:
+                    flush()
+
+        flush()
+    finally:
+        if bulk:
+            cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_logs_ts ON logs (ts)")
 
     # If we inserted anything (or scanned newer data), advance the state
-    if new_ts > last_ts:
-        save_last_ts(new_ts)
+    if new_ts > last_ts or stop != last_offset or inode != last_inode:
+        save_state(new_ts, stop, inode)
 
     cur.close()
     conn.close()
 
     print(
         f"Ingest complete. Scanned={scanned}, inserted={inserted}, "
-        f"skipped_old={skipped_old}, skipped_dupe={skipped_dupe}, "
-        f"last_ts={last_ts.isoformat()}, new_ts={new_ts.isoformat()}"
+        f"skipped_old={skipped_old}, skipped_dupe={skipped_dupe}, failed={failed}, "
+        f"last_ts={last_ts.isoformat()}, new_ts={new_ts.isoformat()}, "
+        f"bytes={start}..{stop}"
     )
 
 if __name__ == "__main__":
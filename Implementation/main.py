@@ -1,28 +1,56 @@
 import os
 import re
-import json
 import time
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
 load_dotenv()
 
+def cast_bytea_hex(value, cur):
+    """bytea → hex str (e.g. logs.raw_sha256) so rows stay JSON-serializable."""
+    if value is None:
+        return None
+    return psycopg2.BINARY(value, cur).tobytes().hex()
+
+psycopg2.extensions.register_type(
+    psycopg2.extensions.new_type(psycopg2.BINARY.values, "BYTEA_HEX", cast_bytea_hex)
+)
+
 PGHOST = os.getenv("PGHOST", "127.0.0.1")
 PGPORT = int(os.getenv("PGPORT", "5432"))
 PGDB   = os.getenv("PGDATABASE", "soc_logs")
 PGUSER = os.getenv("PGUSER", "soc_user")
 PGPW   = os.getenv("PGPASSWORD", "")
 
+# minconn 0: nothing is opened eagerly, so the API starts even if Postgres is down
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "0"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "16"))
+STATEMENT_TIMEOUT_MS = 8000
+
 OLLAMA_BASE = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
 
 MAX_ROWS = int(os.getenv("MAX_ROWS", "200"))
 DEFAULT_WINDOW_HOURS = int(os.getenv("DEFAULT_WINDOW_HOURS", "24"))
 
+# question → validated SQL, so repeated questions skip the LLM entirely
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "1024"))
+SQL_CACHE_TTL  = int(os.getenv("SQL_CACHE_TTL", "600"))
+# SQL → rows, short-lived so identical follow-ups skip the DB too
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "10"))
+
 SCHEMA_HINT = """
 You are a SOC analyst assistant that converts natural language to PostgreSQL SQL.
 
@@ -110,7 +138,14 @@ PROHIBITED
 - When filtering by substrings in rule_desc, use ILIKE '%term%'.
 """.strip().format(hours=DEFAULT_WINDOW_HOURS, limit=MAX_ROWS)
 
-DENYLIST = re.compile(r"\b(INSERT|UPDATE|DELETE|ALTER|DROP|TRUNCATE|CREATE|GRANT|REVOKE)\b", re.IGNORECASE)
+# SQL keywords that must never appear in generated SQL; checked as a set
+# lookup over the statement's word tokens (one linear pass, no alternation)
+DENYLIST = frozenset(("INSERT", "UPDATE", "DELETE", "ALTER", "DROP", "TRUNCATE", "CREATE", "GRANT", "REVOKE"))
+
+WORD_RE   = re.compile(r"\w+")
+FENCE_RE  = re.compile(r"```(?:sql)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+SELECT_RE = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+LIMIT_RE  = re.compile(r"\bLIMIT\b", re.IGNORECASE)
 
 class AskRequest(BaseModel):
     question: str
@@ -121,33 +156,104 @@ class AskResponse(BaseModel):
     rowcount: int
     latency_ms: int
 
-app = FastAPI(title="LLM-Powered SOC Assistant (NL → SQL)", version="0.1")
+# TTLCache isn't thread-safe and sync endpoints run in a threadpool
+SQL_CACHE = TTLCache(maxsize=SQL_CACHE_SIZE, ttl=SQL_CACHE_TTL)
+RESULT_CACHE = TTLCache(maxsize=256, ttl=RESULT_CACHE_TTL)
+CACHE_LOCK = threading.Lock()
+
+def question_key(question: str) -> bytes:
+    """Cache key for a question: whitespace-insensitive, but case is kept
+    (agent/user names are matched exactly in the generated SQL)."""
+    norm = " ".join(question.split())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).digest()
+
+# shared DB connections, created on first use so the API starts (and /healthz
+# can report it) even while Postgres is down
+POOL: ThreadedConnectionPool | None = None
+POOL_LOCK = threading.Lock()
+# getconn() raises PoolError instead of waiting when all connections are out,
+# so callers queue here first; the threadpool runs more requests than that
+POOL_SLOTS = threading.BoundedSemaphore(PG_POOL_MAX)
+
+def get_pool() -> ThreadedConnectionPool:
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ThreadedConnectionPool(
+                minconn=PG_POOL_MIN, maxconn=PG_POOL_MAX,
+                host=PGHOST, port=PGPORT, dbname=PGDB, user=PGUSER, password=PGPW,
+                # session-level timeout set at connect, so no SET per query
+                options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+            )
+        return POOL
+
+# nothing to open up front (pool is lazy); close pooled connections on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if POOL is not None:
+        POOL.closeall()
+
+app = FastAPI(title="LLM-Powered SOC Assistant (NL → SQL)", version="0.1", lifespan=lifespan)
+
+# keep-alive HTTP connections to Ollama reused across requests
+OLLAMA_SESSION = requests.Session()
+OLLAMA_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+OLLAMA_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# /api/chat body around the user message, encoded once: SCHEMA_HINT is a few KB
+# and never changes, so only the question is serialized per request
+OLLAMA_BODY_HEAD = (
+    b'{"model":' + orjson.dumps(OLLAMA_MODEL)
+    + b',"messages":[{"role":"system","content":' + orjson.dumps(SCHEMA_HINT)
+    + b'},{"role":"user","content":'
+)
+OLLAMA_BODY_TAIL = b'}],"stream":true}'
+
+def sql_complete(text: str) -> bool:
+    """
+    True once streamed model output already holds everything extract_sql needs:
+    a closed code fence, or (without any fence) a SELECT ended by a semicolon.
+    A semicolon in leading prose ("Sure; here is the query: ...") doesn't
+    count, so the stream keeps going until the fenced SQL arrives.
+    """
+    if "```" in text:
+        return FENCE_RE.search(text) is not None
+    semi = text.find(";")
+    return semi != -1 and SELECT_RE.match(text[:semi]) is not None
 
 def call_ollama_for_sql(question: str) -> str:
     """
     Calls Ollama /api/chat with a system+user prompt and returns raw text.
+    The reply is streamed and the stream is dropped as soon as the SQL is complete.
     """
     url = f"{OLLAMA_BASE}/api/chat"
-    payload = {
-        "model": OLLAMA_MODEL,
-        "messages": [
-            {"role": "system", "content": SCHEMA_HINT},
-            {"role": "user", "content": f"Question: {question}\nReturn only SQL for PostgreSQL."}
-        ],
-        "stream": False
-    }
-    r = requests.post(url, json=payload, timeout=60)
-    r.raise_for_status()
-    data = r.json()
-    text = data.get("message", {}).get("content", "")
-    return text.strip()
+    user_msg = f"Question: {question}\nReturn only SQL for PostgreSQL."
+    body = OLLAMA_BODY_HEAD + orjson.dumps(user_msg) + OLLAMA_BODY_TAIL
+    parts = []
+    with OLLAMA_SESSION.post(
+        url, data=body, headers={"Content-Type": "application/json"}, stream=True, timeout=60
+    ) as r:
+        r.raise_for_status()
+        for chunk in r.iter_lines():
+            if not chunk:
+                continue
+            data = orjson.loads(chunk)
+            piece = data.get("message", {}).get("content", "")
+            parts.append(piece)
+            if data.get("done"):
+                break
+            # only re-check the joined text when this piece could close the SQL
+            if ("`" in piece or ";" in piece) and sql_complete("".join(parts)):
+                break
+    return "".join(parts).strip()
 
 def extract_sql(text: str) -> str:
     """
     Extract the SQL from model output (handles code fences or plain text).
     """
     # ```sql ... ```
-    m = re.search(r"```(?:sql)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    m = FENCE_RE.search(text)
     if m:
         sql = m.group(1).strip()
     else:
@@ -156,46 +262,70 @@ def extract_sql(text: str) -> str:
         sql = text[:semi+1].strip() if semi != -1 else text.strip()
 
     # enforce SELECT-only
-    if DENYLIST.search(sql):
+    if not DENYLIST.isdisjoint(WORD_RE.findall(sql.upper())):
         raise HTTPException(status_code=400, detail="Generated SQL contains non-SELECT statements. Aborting.")
-    if not re.match(r"^\s*SELECT\b", sql, re.IGNORECASE):
+    if not SELECT_RE.match(sql):
         raise HTTPException(status_code=400, detail="Generated SQL is not a SELECT.")
     return sql
 
 def run_sql(sql: str):
     """
-    Executes SQL with a per-query timeout and returns rows as dicts.
+    Executes SQL on a pooled connection (statement_timeout is set per
+    session) and returns rows as dicts.
     """
     t0 = time.time()
-    conn = psycopg2.connect(host=PGHOST, port=PGPORT, dbname=PGDB, user=PGUSER, password=PGPW)
-    try:
-        with conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # per-transaction timeout (in ms)
-                cur.execute("SET LOCAL statement_timeout = 8000;")
-                cur.execute(sql)
-                rows = cur.fetchall()
-    finally:
-        conn.close()
+    with POOL_SLOTS:
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(sql)
+                    rows = cur.fetchall()
+        finally:
+            # drop connections the server closed instead of handing them out again
+            pool.putconn(conn, close=bool(conn.closed))
     latency_ms = int((time.time() - t0) * 1000)
     return rows, latency_ms
 
 @app.post("/ask", response_model=AskResponse)
 def ask(req: AskRequest):
-    # 1) ask LLM for SQL
-    raw = call_ollama_for_sql(req.question)
-    sql = extract_sql(raw)
+    key = question_key(req.question)
+    with CACHE_LOCK:
+        sql = SQL_CACHE.get(key)
+    generated = sql is None
 
-    # 2) sanity: add LIMIT if missing (to protect from huge scans)
-    if re.search(r"\bLIMIT\b", sql, re.IGNORECASE) is None:
-        sql = f"{sql.rstrip(';')} LIMIT {MAX_ROWS};"
+    if generated:
+        # 1) ask LLM for SQL
+        raw = call_ollama_for_sql(req.question)
+        sql = extract_sql(raw)
 
-    # 3) run
-    try:
-        rows, latency_ms = run_sql(sql)
-    except psycopg2.Error as e:
-        # bubble up DB errors but keep message concise
-        raise HTTPException(status_code=400, detail=f"SQL execution error: {e.pgerror or str(e)}")
+        # 2) sanity: add LIMIT if missing (to protect from huge scans)
+        if LIMIT_RE.search(sql) is None:
+            sql = f"{sql.rstrip(';')} LIMIT {MAX_ROWS};"
+
+    # 3) run (or reuse a very recent identical result)
+    with CACHE_LOCK:
+        cached = RESULT_CACHE.get(sql)
+    if cached is not None:
+        rows, latency_ms = cached, 0
+    else:
+        try:
+            rows, latency_ms = run_sql(sql)
+        except psycopg2.Error as e:
+            # don't pin SQL that fails; a retry should get a fresh generation
+            with CACHE_LOCK:
+                SQL_CACHE.pop(key, None)
+            # bubble up DB errors but keep message concise
+            raise HTTPException(status_code=400, detail=f"SQL execution error: {e.pgerror or str(e)}")
+        with CACHE_LOCK:
+            RESULT_CACHE[sql] = rows
+
+    # only freshly generated SQL that actually ran is stored; re-storing on
+    # hits would restart the TTL and never let the question be regenerated
+    if generated:
+        with CACHE_LOCK:
+            SQL_CACHE[key] = sql
 
     return AskResponse(sql=sql, rows=rows, rowcount=len(rows), latency_ms=latency_ms)
 